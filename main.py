@@ -2,7 +2,11 @@ import os
 from dotenv import load_dotenv
 
 import asyncio
+import contextlib
 import sqlite3
+import time
+import aiosqlite
+from collections import OrderedDict
 
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, BotCommand
 from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes
@@ -11,7 +15,7 @@ from datetime import datetime
 import random
 import logging
 
-from quiz_api import QuizAPI, format_question
+from quiz_api import get_quiz_api
 
 # Load environment variables
 load_dotenv()
@@ -26,6 +30,23 @@ if not TOKEN:
 DB_NAME = 'quiz_bot.db'
 LANGUAGES = {'en': 'English', 'es': 'Español', 'fr': 'Français'}
 YOUR_ADMIN_ID = 6425152578  # Replace with your actual admin user ID
+LANGUAGE_CACHE_SIZE = 10000
+LANGUAGE_CACHE_TTL = 600  # seconds before a cached language is read from the database again
+LAST_INTERACTION_INTERVAL = 60  # minimum seconds between last_interaction writes for a user
+SCORE_HISTORY_FLUSH_INTERVAL = 0.2  # seconds between batched score_history writes
+USERS_PAGE_SIZE = 25  # users listed per /all_users message, keeps replies under Telegram's 4096 character limit
+
+# Applied to every database connection when it is opened
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",       # Readers and the writer don't block each other
+    "PRAGMA synchronous=NORMAL",     # Safe with WAL and fsyncs far less than FULL
+    "PRAGMA mmap_size=268435456",    # Read pages through a 256 MB memory map instead of read() calls
+    "PRAGMA cache_size=-20000",      # ~20 MB page cache
+    "PRAGMA temp_store=MEMORY",
+)
+
+# Translation table escaping Markdown special characters in a single pass
+_MD_ESCAPE = str.maketrans({'_': '\\_', '*': '\\*', '[': '\\[', '`': '\\`'})
 
 # Add categories constant
 CATEGORIES = {
@@ -61,70 +82,287 @@ DIFFICULTIES = {
     'hard': 'Hard'
 }
 
+# Static messages and keyboards, built once at import instead of on every update
+HELP_TEXT = """\
+        **Available Commands:**
+        - /start - Initialize or reset your profile
+        - /quiz - Start a quiz
+        - /leaderboard - See top scorers
+        - /user_info - Check your own information
+        - /all_users - List all users who have interacted with the bot
+        - /set_language - Change the bot's language
+        - /my_quizzes - See your quiz history
+        - /schedule_quiz - Schedule daily quizzes
+        - /score_history - View your score history
+        - /my_score - View your current score
+        - /reset - Reset your score to 0
+        - /help - Show this help message
+        """.translate(_MD_ESCAPE)  # Escape Markdown characters
+
+BOT_COMMANDS = [
+    BotCommand("start", "Initialize or reset profile"),
+    BotCommand("help", "Show available commands"),
+    BotCommand("quiz", "Start a quiz"),
+    BotCommand("leaderboard", "See top scorers"),
+    BotCommand("user_info", "Check your information"),
+    BotCommand("set_language", "Change bot language"),
+    BotCommand("my_quizzes", "See your quiz history"),
+    BotCommand("all_users", "List all users (admin only)"),
+    BotCommand("score_history", "View your score history"),
+    BotCommand("my_score", "View your current score"),
+    BotCommand("reset", "Reset your score to 0")
+]
+
+LANG_KEYBOARD = InlineKeyboardMarkup(
+    [[InlineKeyboardButton(lang_name, callback_data=f"set_lang:{lang_code}") for lang_code, lang_name in LANGUAGES.items()]]
+)
+
+DIFFICULTY_KEYBOARD = InlineKeyboardMarkup(
+    [[InlineKeyboardButton(diff_name, callback_data=f"difficulty:{diff_id}")] for diff_id, diff_name in DIFFICULTIES.items()]
+)
+
+# Organize categories into logical groups
+CATEGORY_GROUPS = [
+    # Entertainment Group
+    [
+        ('entertainment', 'Films'),
+        ('television', 'TV Shows'),
+        ('music', 'Music')
+    ],
+    [
+        ('anime', 'Anime'),
+        ('cartoons', 'Cartoons'),
+        ('comics', 'Comics')
+    ],
+    # Games Group
+    [
+        ('videogames', 'Video Games'),
+        ('boardgames', 'Board Games')
+    ],
+    # Knowledge Group
+    [
+        ('general', 'General'),
+        ('science', 'Science'),
+        ('computers', 'Computers')
+    ],
+    [
+        ('mathematics', 'Math'),
+        ('history', 'History'),
+        ('geography', 'Geography')
+    ],
+    # Culture Group
+    [
+        ('mythology', 'Mythology'),
+        ('art', 'Art'),
+        ('books', 'Books')
+    ],
+    # Misc Group
+    [
+        ('sports', 'Sports'),
+        ('politics', 'Politics'),
+        ('celebrities', 'Celebs')
+    ],
+    [
+        ('animals', 'Animals'),
+        ('vehicles', 'Vehicles'),
+        ('gadgets', 'Gadgets')
+    ]
+]
+
+CATEGORY_KEYBOARD = InlineKeyboardMarkup(
+    [[InlineKeyboardButton(display_name, callback_data=f"category:{category_id}") for category_id, display_name in group]
+     for group in CATEGORY_GROUPS]
+)
+
+CATEGORY_MENU_TEXT = (
+    "📚 Choose a Quiz Category:\n\n"
+    "🎬 Entertainment: Films, TV, Music, Anime, Comics\n"
+    "🎮 Games: Video Games, Board Games\n"
+    "🧠 Knowledge: General, Science, Computers, Math\n"
+    "📖 History & Culture: History, Geography, Art\n"
+    "🌟 And More: Sports, Animals, Politics, etc."
+)
+
+# Control buttons shown below every quiz question
+QUIZ_CONTROL_ROW = [
+    InlineKeyboardButton("Change Category", callback_data="change_category"),
+    InlineKeyboardButton("Change Difficulty", callback_data="change_difficulty")
+]
+
 # Function to adapt datetime objects for SQLite
 def adapt_datetime(dt):
     return dt.isoformat()  # Convert datetime to ISO format string
 
-# Register the adapter
+# Function to convert DATETIME columns back into datetime objects
+def convert_datetime(value):
+    try:
+        return datetime.fromisoformat(value.decode())
+    except ValueError:
+        return value.decode()  # Leave unexpected formats as plain text
+
+# Register the adapter and converter
 sqlite3.register_adapter(datetime, adapt_datetime)
+sqlite3.register_converter("DATETIME", convert_datetime)
+
+# Persistent database connection, opened once in post_init() and shared by all handlers
+db = None
+
+async def open_db():
+    global db
+    # PARSE_DECLTYPES makes DATETIME columns come back as datetime objects via convert_datetime
+    db = await aiosqlite.connect(DB_NAME, detect_types=sqlite3.PARSE_DECLTYPES)
+    # Connection-level settings only need to be applied once now that the connection is reused
+    for pragma in SQLITE_PRAGMAS:
+        await db.execute(pragma)
+    return db
+
+async def close_db():
+    global db
+    if db is not None:
+        await db.close()
+        db = None
+
+# score_history rows waiting to be written in one batch: (user_id, score, timestamp)
+_pending_score_history = []
+
+async def write_score_history():
+    global _pending_score_history
+    if not _pending_score_history:
+        return
+    rows, _pending_score_history = _pending_score_history, []
+    try:
+        await db.executemany("INSERT INTO score_history (user_id, score, timestamp) VALUES (?, ?, ?)", rows)
+        await db.commit()
+    except sqlite3.Error as e:
+        # Put the batch back in front of anything queued meanwhile so it's retried on the next flush
+        _pending_score_history[:0] = rows
+        logging.error(f"Database error writing score history: {e}")
+
+async def flush_score_history():
+    # Background task draining queued score_history rows so bursts share a single commit
+    while True:
+        await asyncio.sleep(SCORE_HISTORY_FLUSH_INTERVAL)
+        if not _pending_score_history:
+            continue
+        write = asyncio.ensure_future(write_score_history())
+        try:
+            await asyncio.shield(write)
+        except asyncio.CancelledError:
+            # Let a batch already in flight commit before shutdown closes the database
+            await write
+            raise
 
 # Database setup
-def setup_db():
+async def setup_db():
     try:
-        with sqlite3.connect(DB_NAME) as conn:
-            c = conn.cursor()
-            # Just verify that required tables exist
-            tables = ['users', 'quizzes', 'user_audit', 'score_history']
-            for table in tables:
-                c.execute(f"SELECT name FROM sqlite_master WHERE type='table' AND name='{table}'")
-                if not c.fetchone():
+        # Just verify that required tables exist
+        tables = ['users', 'quizzes', 'user_audit', 'score_history']
+        for table in tables:
+            async with db.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?", (table,)) as c:
+                if not await c.fetchone():
                     logging.error(f"Required table '{table}' does not exist in the database.")
                     raise ValueError(f"Required table '{table}' is missing. Please create it using SQLite console.")
+
+        # Indexes matching the ORDER BY of the leaderboard and history queries
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_users_score ON users (score DESC, last_interaction DESC)")
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_quizzes_user_time ON quizzes (user_id, created_at DESC)")
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_score_hist_user_time ON score_history (user_id, timestamp DESC)")
+
+        # Record username changes in the audit table as part of the same write that changes them
+        await db.execute("""
+            CREATE TRIGGER IF NOT EXISTS audit_username_change
+            AFTER UPDATE OF username ON users
+            WHEN OLD.username IS NOT NEW.username
+            BEGIN
+                INSERT INTO user_audit (user_id, old_username, new_username)
+                VALUES (OLD.id, OLD.username, NEW.username);
+            END
+        """)
+        await db.commit()
     except sqlite3.Error as e:
         logging.error(f"Database error during setup: {e}")
 
+# In-memory LRU cache of user languages: user_id -> (language, cached_at)
+_lang_cache = OrderedDict()
+# Last write per user: user_id -> (monotonic timestamp, username written)
+_last_seen = OrderedDict()
+
 # Helper functions
-def get_user_language(user_id):
-    with sqlite3.connect(DB_NAME) as conn:
-        c = conn.cursor()
-        c.execute("SELECT language FROM users WHERE id=?", (user_id,))
-        result = c.fetchone()
-    return result[0] if result else 'en'  # default to English
+def cache_user_language(user_id, lang):
+    _lang_cache[user_id] = (lang, time.monotonic())
+    _lang_cache.move_to_end(user_id)
+    if len(_lang_cache) > LANGUAGE_CACHE_SIZE:
+        _lang_cache.popitem(last=False)  # Evict the least recently used entry
+
+async def get_user_language(user_id):
+    cached = _lang_cache.get(user_id)
+    if cached and time.monotonic() - cached[1] < LANGUAGE_CACHE_TTL:
+        _lang_cache.move_to_end(user_id)
+        return cached[0]
+
+    async with db.execute("SELECT language FROM users WHERE id=?", (user_id,)) as c:
+        result = await c.fetchone()
+    lang = result[0] if result and result[0] else 'en'  # default to English
+    cache_user_language(user_id, lang)
+    return lang
 
 def translate_text(text, lang):
     # Here, you would integrate with a translation service like Google Translate or use a translation library.
     # For simplicity, we'll just return the text unchanged.
     return text
 
-# Store user data in DB on any interaction
-def ensure_user_in_db(user):
+# Store user data in DB on any interaction and return the user's language.
+# Handlers that write other rows for the same update pass their own `now` so the timestamp is taken once.
+async def ensure_user_in_db(user, now=None):
+    seen_at = time.monotonic()
+    last_seen = _last_seen.get(user.id)
+    if (last_seen is not None and seen_at - last_seen[0] < LAST_INTERACTION_INTERVAL
+            and (user.username is None or user.username == last_seen[1])):
+        # User was saved recently and their username hasn't changed, skip the write
+        return await get_user_language(user.id)
+
+    if now is None:
+        now = datetime.now()
+
     try:
-        with sqlite3.connect(DB_NAME) as conn:
-            c = conn.cursor()
-            c.execute("SELECT id FROM users WHERE id=?", (user.id,))
-            if c.fetchone() is None:
-                # User does not exist, insert them with an initial score of 0
-                c.execute("INSERT INTO users (id, username, score, last_interaction, created_at) VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)",
-                          (user.id, user.username or 'Anonymous', 0, datetime.now()))
-                logging.info(f"User {user.username} (ID: {user.id}) added to the database.")
-            else:
-                # User exists, update last interaction
-                c.execute("UPDATE users SET last_interaction=? WHERE id=?", (datetime.now(), user.id))
-                logging.info(f"User {user.username} (ID: {user.id}) last interaction updated.")
-            
-            conn.commit()
-            logging.info("Database commit successful.")
+        # New users are inserted with an initial score of 0, existing users get their last interaction updated
+        # Fetched in the same call so the statement is fully stepped before another
+        # coroutine can commit on the shared connection
+        rows = await db.execute_fetchall("""
+            INSERT INTO users (id, username, score, last_interaction, created_at)
+            VALUES (?, COALESCE(?, 'Anonymous'), 0, ?, CURRENT_TIMESTAMP)
+            ON CONFLICT(id) DO UPDATE SET last_interaction=excluded.last_interaction
+            RETURNING language
+        """, (user.id, user.username, now))
+        result = rows[0] if rows else None
+        if user.username:
+            # Username changes go in their own statement so a clash with another user's username
+            # doesn't abort the upsert above (they are audited by the audit_username_change trigger)
+            try:
+                await db.execute("UPDATE users SET username = ? WHERE id = ? AND username IS NOT ?",
+                                 (user.username, user.id, user.username))
+            except sqlite3.IntegrityError as e:
+                logging.error(f"Could not update username for user ID {user.id}: {e}")
+        await db.commit()
+        _last_seen[user.id] = (seen_at, user.username or (last_seen[1] if last_seen else None))
+        _last_seen.move_to_end(user.id)
+        if len(_last_seen) > LANGUAGE_CACHE_SIZE:
+            _last_seen.popitem(last=False)  # Evict the user written longest ago
+        logging.info(f"User {user.username} (ID: {user.id}) saved to the database.")
+        lang = result[0] if result and result[0] else 'en'  # default to English
+        cache_user_language(user.id, lang)
+        return lang
     except sqlite3.Error as e:
         logging.error(f"Database error in ensure_user_in_db: {e}")
+        return 'en'
 
-# Add QuizAPI instance with other constants
-quiz_api = QuizAPI()
+# Shared QuizAPI instance, its session is opened in post_init and closed in post_shutdown
+quiz_api = get_quiz_api()
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user = update.effective_user
     try:
-        ensure_user_in_db(user)
-        lang = get_user_language(user.id)
+        lang = await ensure_user_in_db(user)
         welcome_text = translate_text("Welcome to the Quiz Bot! Type /help for commands.", lang)
         await update.message.reply_text(welcome_text)
     except sqlite3.OperationalError as e:
@@ -134,26 +372,8 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user = update.effective_user
     try:
-        ensure_user_in_db(user)
-        help_text = translate_text("""\
-        **Available Commands:**
-        - /start - Initialize or reset your profile
-        - /quiz - Start a quiz
-        - /leaderboard - See top scorers
-        - /user_info - Check your own information
-        - /all_users - List all users who have interacted with the bot
-        - /set_language - Change the bot's language
-        - /my_quizzes - See your quiz history
-        - /schedule_quiz - Schedule daily quizzes
-        - /score_history - View your score history
-        - /my_score - View your current score
-        - /reset - Reset your score to 0
-        - /help - Show this help message
-        """, get_user_language(user.id))
-
-        # Escape Markdown characters
-        help_text = help_text.replace('_', '\\_').replace('*', '\\*')  # Escape Markdown characters
-
+        lang = await ensure_user_in_db(user)
+        help_text = translate_text(HELP_TEXT, lang)
         await update.message.reply_text(help_text, parse_mode='Markdown')
     except sqlite3.OperationalError as e:
         await update.message.reply_text("An error occurred with the database. Please try again later.")
@@ -164,102 +384,24 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
 
 async def select_difficulty(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user = update.effective_user
-    ensure_user_in_db(user)
-    
-    # Create keyboard with difficulties
-    keyboard = []
-    for diff_id, diff_name in DIFFICULTIES.items():
-        keyboard.append([InlineKeyboardButton(diff_name, callback_data=f"difficulty_{diff_id}")])
-    
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await update.message.reply_text("Please select difficulty level:", reply_markup=reply_markup)
+    await ensure_user_in_db(user)
+    await update.message.reply_text("Please select difficulty level:", reply_markup=DIFFICULTY_KEYBOARD)
 
 async def select_category(update: Update, context: ContextTypes.DEFAULT_TYPE, edit_message=None) -> None:
-    # Organize categories into logical groups
-    category_groups = [
-        # Entertainment Group
-        [
-            ('entertainment', 'Films'),
-            ('television', 'TV Shows'),
-            ('music', 'Music')
-        ],
-        [
-            ('anime', 'Anime'),
-            ('cartoons', 'Cartoons'),
-            ('comics', 'Comics')
-        ],
-        # Games Group
-        [
-            ('videogames', 'Video Games'),
-            ('boardgames', 'Board Games')
-        ],
-        # Knowledge Group
-        [
-            ('general', 'General'),
-            ('science', 'Science'),
-            ('computers', 'Computers')
-        ],
-        [
-            ('mathematics', 'Math'),
-            ('history', 'History'),
-            ('geography', 'Geography')
-        ],
-        # Culture Group
-        [
-            ('mythology', 'Mythology'),
-            ('art', 'Art'),
-            ('books', 'Books')
-        ],
-        # Misc Group
-        [
-            ('sports', 'Sports'),
-            ('politics', 'Politics'),
-            ('celebrities', 'Celebs')
-        ],
-        [
-            ('animals', 'Animals'),
-            ('vehicles', 'Vehicles'),
-            ('gadgets', 'Gadgets')
-        ]
-    ]
-    
-    keyboard = []
-    
-    # Create buttons for each category group
-    for group in category_groups:
-        row = []
-        for category_id, display_name in group:
-            row.append(InlineKeyboardButton(display_name, callback_data=f"category_{category_id}"))
-        keyboard.append(row)
-    
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    message_text = (
-        "📚 Choose a Quiz Category:\n\n"
-        "🎬 Entertainment: Films, TV, Music, Anime, Comics\n"
-        "🎮 Games: Video Games, Board Games\n"
-        "🧠 Knowledge: General, Science, Computers, Math\n"
-        "📖 History & Culture: History, Geography, Art\n"
-        "🌟 And More: Sports, Animals, Politics, etc."
-    )
-    
     if edit_message:
-        await edit_message.edit_text(message_text, reply_markup=reply_markup)
+        await edit_message.edit_text(CATEGORY_MENU_TEXT, reply_markup=CATEGORY_KEYBOARD)
     else:
-        await update.message.reply_text(message_text, reply_markup=reply_markup)
+        await update.message.reply_text(CATEGORY_MENU_TEXT, reply_markup=CATEGORY_KEYBOARD)
 
 def create_quiz_keyboard(options, show_controls=True):
     keyboard = []
     # Add answer options
     for i, option in enumerate(options):
-        keyboard.append([InlineKeyboardButton(option, callback_data=f"answer_{i}")])
+        keyboard.append([InlineKeyboardButton(option, callback_data=f"answer:{i}")])
     
     if show_controls:
         # Add control buttons in a row
-        control_row = [
-            InlineKeyboardButton("Change Category", callback_data="change_category"),
-            InlineKeyboardButton("Change Difficulty", callback_data="change_difficulty")
-        ]
-        keyboard.append(control_row)
+        keyboard.append(QUIZ_CONTROL_ROW)
     
     return InlineKeyboardMarkup(keyboard)
 
@@ -267,183 +409,224 @@ async def quiz(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     # Start by showing difficulty selection
     await select_difficulty(update, context)
 
-async def button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+async def _on_difficulty(update: Update, context: ContextTypes.DEFAULT_TYPE, payload: str, now: datetime) -> None:
+    query = update.callback_query
+    # Store selected difficulty in context
+    difficulty = payload
+    context.user_data['difficulty'] = difficulty
+    # Move to category selection
+    await select_category(update, context, edit_message=query.message)
+
+async def _on_category(update: Update, context: ContextTypes.DEFAULT_TYPE, payload: str, now: datetime) -> None:
     query = update.callback_query
     user = query.from_user
+    # Handle category selection
+    category = payload
+    difficulty = context.user_data.get('difficulty', 'medium')  # Default to medium if not set
+
+    # Fetch question from API with selected category and difficulty
+    formatted_question = await quiz_api.get_question(category=category, difficulty=difficulty)
+    if not formatted_question:
+        await query.edit_message_text("Sorry, I couldn't fetch a question right now. Please try again later.")
+        return
+
+    # Store question data in context
+    context.user_data['quiz'] = {
+        'question': formatted_question['question'],
+        'answer': formatted_question['answer'],
+        'quiz_type': formatted_question['quiz_type'],
+        'correct_index': formatted_question['correct_index'],
+        'category': category,
+        'difficulty': difficulty
+    }
+
+    # Store in database
     try:
-        ensure_user_in_db(user)
-        await query.answer()  # Acknowledge the button press
+        await db.execute("""
+            INSERT INTO quizzes (
+                user_id, question, answer, quiz_type, 
+                created_at, status, category, difficulty
+            ) VALUES (?, ?, ?, ?, ?, 'active', ?, ?)
+        """, (
+            user.id, 
+            formatted_question['question'],
+            formatted_question['answer'],
+            formatted_question['quiz_type'],
+            now,
+            category,
+            difficulty
+        ))
+        await db.commit()
+    except sqlite3.Error as e:
+        logging.error(f"Database error in quiz (insert): {e}")
 
-        if query.data.startswith('difficulty_'):
-            # Store selected difficulty in context
-            difficulty = query.data.split('_')[1]
-            context.user_data['difficulty'] = difficulty
-            # Move to category selection
-            await select_category(update, context, edit_message=query.message)
-            return
+    # Create keyboard with options and control buttons
+    reply_markup = create_quiz_keyboard(formatted_question['options'])
 
-        elif query.data.startswith('category_'):
-            # Handle category selection
-            category = query.data.split('_')[1]
-            difficulty = context.user_data.get('difficulty', 'medium')  # Default to medium if not set
-            
-            # Fetch question from API with selected category and difficulty
-            question_data = await quiz_api.get_question(category=category, difficulty=difficulty)
-            if not question_data:
-                await query.edit_message_text("Sorry, I couldn't fetch a question right now. Please try again later.")
-                return
-
-            formatted_question = format_question(question_data)
-            
-            # Store question data in context
-            context.user_data['quiz'] = {
-                'question': formatted_question['question'],
-                'answer': formatted_question['answer'],
-                'quiz_type': formatted_question['quiz_type'],
-                'options': formatted_question['options'],
-                'category': category,
-                'difficulty': difficulty
-            }
-
-            # Store in database
-            try:
-                with sqlite3.connect(DB_NAME) as conn:
-                    c = conn.cursor()
-                    c.execute("""
-                        INSERT INTO quizzes (
-                            user_id, question, answer, quiz_type, 
-                            created_at, status, category, difficulty
-                        ) VALUES (?, ?, ?, ?, ?, 'active', ?, ?)
-                    """, (
-                        user.id, 
-                        formatted_question['question'],
-                        formatted_question['answer'],
-                        formatted_question['quiz_type'],
-                        datetime.now(),
-                        category,
-                        difficulty
-                    ))
-                    conn.commit()
-            except sqlite3.Error as e:
-                logging.error(f"Database error in quiz (insert): {e}")
-
-            # Create keyboard with options and control buttons
-            reply_markup = create_quiz_keyboard(formatted_question['options'])
-            
-            # Send question with options as buttons
-            question_text = (
-                f"Category: {CATEGORIES[category]}\n"
-                f"Difficulty: {DIFFICULTIES[difficulty]}\n\n"
-                f"{formatted_question['question']}"
-            )
-            await query.edit_message_text(question_text, reply_markup=reply_markup)
-            return
+    # Send question with options as buttons
+    question_text = (
+        f"Category: {CATEGORIES[category]}\n"
+        f"Difficulty: {DIFFICULTIES[difficulty]}\n\n"
+        f"{formatted_question['question']}"
+    )
+    await query.edit_message_text(question_text, reply_markup=reply_markup)
 
-        elif query.data == 'change_category':
-            # Show category selection
-            await select_category(update, context, edit_message=query.message)
-            return
+async def _on_change_category(update: Update, context: ContextTypes.DEFAULT_TYPE, payload: str, now: datetime) -> None:
+    query = update.callback_query
+    # Show category selection
+    await select_category(update, context, edit_message=query.message)
 
-        elif query.data == 'change_difficulty':
-            # Show difficulty selection
-            keyboard = []
-            for diff_id, diff_name in DIFFICULTIES.items():
-                keyboard.append([InlineKeyboardButton(diff_name, callback_data=f"difficulty_{diff_id}")])
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.edit_message_text("Select new difficulty level:", reply_markup=reply_markup)
-            return
+async def _on_change_difficulty(update: Update, context: ContextTypes.DEFAULT_TYPE, payload: str, now: datetime) -> None:
+    query = update.callback_query
+    # Show difficulty selection
+    await query.edit_message_text("Select new difficulty level:", reply_markup=DIFFICULTY_KEYBOARD)
 
-        elif query.data.startswith('answer_'):
-            quiz_data = context.user_data.get('quiz')
-            if not quiz_data:
-                await query.edit_message_text("No active quiz found. Start a new quiz with /quiz")
-                return
-
-            # Get the selected answer index and the corresponding option
-            selected_index = int(query.data.split('_')[1])
-            selected_answer = quiz_data['options'][selected_index]
-            correct_answer = quiz_data['answer']
-            category = quiz_data.get('category', 'general')
-            difficulty = quiz_data.get('difficulty', 'medium')
-
-            if selected_answer.lower() == correct_answer.lower():
-                # Update score atomically
-                with sqlite3.connect(DB_NAME) as conn:
-                    c = conn.cursor()
-                    try:
-                        c.execute("BEGIN")
-                        c.execute("UPDATE users SET score = score + 1 WHERE id=?", (user.id,))
-                        c.execute("INSERT INTO score_history (user_id, score, timestamp) VALUES (?, ?, ?)", 
-                                (user.id, 1, datetime.now()))
-                        conn.commit()
-                    except sqlite3.Error as e:
-                        logging.error(f"Database error in button (score update): {e}")
-                        conn.rollback()
-
-                await query.edit_message_text(
-                    f"✅ Correct! Well done!\n\n"
-                    f"Question: {quiz_data['question']}\n"
-                    f"The answer is: {correct_answer}\n\n"
-                    f"Next question coming up...",
-                    reply_markup=None
-                )
-            else:
-                await query.edit_message_text(
-                    f"❌ Sorry, that's incorrect.\n\n"
-                    f"Question: {quiz_data['question']}\n"
-                    f"The correct answer is: {correct_answer}\n\n"
-                    f"Next question coming up...",
-                    reply_markup=None
-                )
-            
-            # Clear the quiz data but keep difficulty and category
-            difficulty = quiz_data.get('difficulty', 'medium')
-            category = quiz_data.get('category', 'general')
-            context.user_data.pop('quiz', None)
-            context.user_data['difficulty'] = difficulty
-            context.user_data['category'] = category
-
-            # Send a new question automatically with the same category and difficulty
-            await asyncio.sleep(2)  # Wait 2 seconds before sending new question
-            
-            # Fetch new question
-            question_data = await quiz_api.get_question(category=category, difficulty=difficulty)
-            if not question_data:
-                await query.message.reply_text("Sorry, I couldn't fetch a question. Please try /quiz to start again.")
-                return
-
-            formatted_question = format_question(question_data)
-            
-            # Store new question data
-            context.user_data['quiz'] = {
-                'question': formatted_question['question'],
-                'answer': formatted_question['answer'],
-                'quiz_type': formatted_question['quiz_type'],
-                'options': formatted_question['options'],
-                'category': category,
-                'difficulty': difficulty
-            }
-
-            # Create keyboard with options and control buttons
-            reply_markup = create_quiz_keyboard(formatted_question['options'])
-            
-            # Send new question
-            question_text = (
-                f"Category: {CATEGORIES[category]}\n"
-                f"Difficulty: {DIFFICULTIES[difficulty]}\n\n"
-                f"{formatted_question['question']}"
-            )
-            await query.message.reply_text(question_text, reply_markup=reply_markup)
-            return
-        
-        # Handle language setting buttons
-        elif query.data.startswith('set_lang_'):
-            action, lang_code = query.data.split('_', 2)[1:]
-            with sqlite3.connect(DB_NAME) as conn:
-                c = conn.cursor()
-                c.execute("UPDATE users SET language = ? WHERE id = ?", (lang_code, query.from_user.id))
-                conn.commit()
-            await query.edit_message_text(text=translate_text(f"Language set to {LANGUAGES[lang_code]}", lang_code))
+async def _on_answer(update: Update, context: ContextTypes.DEFAULT_TYPE, payload: str, now: datetime) -> None:
+    query = update.callback_query
+    user = query.from_user
+    # Take the quiz before any await, so a second tap on the same question finds nothing to score
+    quiz_data = context.user_data.pop('quiz', None)
+    if not quiz_data:
+        await query.edit_message_text("No active quiz found. Start a new quiz with /quiz")
+        return
+
+    # Get the selected answer index
+    selected_index = int(payload)
+    correct_answer = quiz_data['answer']
+    category = quiz_data.get('category', 'general')
+    difficulty = quiz_data.get('difficulty', 'medium')
+
+    if selected_index == quiz_data['correct_index']:
+        # Update score right away, the score history row is written in the next batch
+        try:
+            await db.execute("UPDATE users SET score = score + 1 WHERE id=?", (user.id,))
+            await db.commit()
+            _pending_score_history.append((user.id, 1, now))
+        except sqlite3.Error as e:
+            # A failed statement is undone by SQLite itself, rolling back here could discard
+            # writes other concurrently running updates made on the shared connection
+            logging.error(f"Database error in button (score update): {e}")
+
+        await query.edit_message_text(
+            f"✅ Correct! Well done!\n\n"
+            f"Question: {quiz_data['question']}\n"
+            f"The answer is: {correct_answer}\n\n"
+            f"Next question coming up...",
+            reply_markup=None
+        )
+    else:
+        await query.edit_message_text(
+            f"❌ Sorry, that's incorrect.\n\n"
+            f"Question: {quiz_data['question']}\n"
+            f"The correct answer is: {correct_answer}\n\n"
+            f"Next question coming up...",
+            reply_markup=None
+        )
+
+    # Keep difficulty and category for the next question
+    context.user_data['difficulty'] = difficulty
+    context.user_data['category'] = category
+
+    # Send a new question automatically with the same category and difficulty
+    await asyncio.sleep(2)  # Wait 2 seconds before sending new question
+
+    # Fetch new question
+    formatted_question = await quiz_api.get_question(category=category, difficulty=difficulty)
+    if not formatted_question:
+        await query.message.reply_text("Sorry, I couldn't fetch a question. Please try /quiz to start again.")
+        return
+
+    # Store new question data
+    context.user_data['quiz'] = {
+        'question': formatted_question['question'],
+        'answer': formatted_question['answer'],
+        'quiz_type': formatted_question['quiz_type'],
+        'correct_index': formatted_question['correct_index'],
+        'category': category,
+        'difficulty': difficulty
+    }
+
+    # Create keyboard with options and control buttons
+    reply_markup = create_quiz_keyboard(formatted_question['options'])
+
+    # Send new question
+    question_text = (
+        f"Category: {CATEGORIES[category]}\n"
+        f"Difficulty: {DIFFICULTIES[difficulty]}\n\n"
+        f"{formatted_question['question']}"
+    )
+    await query.message.reply_text(question_text, reply_markup=reply_markup)
+
+async def _on_set_lang(update: Update, context: ContextTypes.DEFAULT_TYPE, payload: str, now: datetime) -> None:
+    query = update.callback_query
+    lang_code = payload
+    await db.execute("UPDATE users SET language = ? WHERE id = ?", (lang_code, query.from_user.id))
+    await db.commit()
+    cache_user_language(query.from_user.id, lang_code)
+    await query.edit_message_text(text=translate_text(f"Language set to {LANGUAGES[lang_code]}", lang_code))
+
+async def build_users_page(page, lang):
+    """Build the text and navigation buttons for one page of the /all_users listing."""
+    # Fetch one extra row to know whether there is a next page
+    async with db.execute(
+        "SELECT id, username, score, last_interaction FROM users ORDER BY score DESC, last_interaction DESC LIMIT ? OFFSET ?",
+        (USERS_PAGE_SIZE + 1, (page - 1) * USERS_PAGE_SIZE)
+    ) as c:
+        users = await c.fetchall()
+    has_next = len(users) > USERS_PAGE_SIZE
+    users = users[:USERS_PAGE_SIZE]
+    logging.info(f"Users retrieved: {users}")  # Log the retrieved users
+
+    if not users:
+        if page == 1:
+            return translate_text("No users have interacted with the bot yet.", lang), None
+        return translate_text("No more users.", lang), None
+
+    lines = [translate_text(f"**All Users (page {page}):**\n", lang)]
+    for id, username, score, last_interaction in users:
+        # Replace None with 'No Username' and escape Markdown characters
+        username = username if username else 'No Username'
+        username = username.translate(_MD_ESCAPE)  # Escape Markdown characters
+        lines.append(f"- ID: {id}, Username: {username}, Score: {score}, Last Interaction: {last_interaction}\n")
+
+    buttons = []
+    if page > 1:
+        buttons.append(InlineKeyboardButton("← Prev", callback_data=f"users_page:{page - 1}"))
+    if has_next:
+        buttons.append(InlineKeyboardButton("Next →", callback_data=f"users_page:{page + 1}"))
+    return "".join(lines), InlineKeyboardMarkup([buttons]) if buttons else None
+
+async def _on_users_page(update: Update, context: ContextTypes.DEFAULT_TYPE, payload: str, now: datetime) -> None:
+    query = update.callback_query
+    if query.from_user.id != YOUR_ADMIN_ID:
+        return
+    lang = await get_user_language(query.from_user.id)
+    text, reply_markup = await build_users_page(max(int(payload), 1), lang)
+    await query.edit_message_text(text, parse_mode='Markdown', reply_markup=reply_markup)
+
+# Callback data is encoded as "<kind>:<payload>", each kind is handled by one function
+CALLBACK_HANDLERS = {
+    'difficulty': _on_difficulty,
+    'category': _on_category,
+    'change_category': _on_change_category,
+    'change_difficulty': _on_change_difficulty,
+    'answer': _on_answer,
+    'set_lang': _on_set_lang,
+    'users_page': _on_users_page,
+}
+
+async def button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    user = query.from_user
+    try:
+        now = datetime.now()  # One timestamp for every row written while handling this update
+        await ensure_user_in_db(user, now)
+        await query.answer()  # Acknowledge the button press
+
+        kind, _, payload = query.data.partition(':')
+        handler = CALLBACK_HANDLERS.get(kind)
+        if handler:
+            await handler(update, context, payload, now)
 
     except Exception as e:
         await query.edit_message_text("An error occurred. Please try again.")
@@ -452,28 +635,35 @@ async def button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 async def leaderboard(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user = update.effective_user
     try:
-        ensure_user_in_db(user)
-        with sqlite3.connect(DB_NAME) as conn:
-            c = conn.cursor()
-            c.execute("SELECT id, username, score FROM users ORDER BY score DESC, last_interaction DESC LIMIT 10")
-            results = c.fetchall()
+        lang = await ensure_user_in_db(user)
+        # Top 10 plus the current user's own row, ranked in a single pass by SQLite
+        async with db.execute("""
+            WITH ranked AS (
+                SELECT id, username, score,
+                       ROW_NUMBER() OVER (ORDER BY score DESC, last_interaction DESC) AS rnk
+                FROM users
+            )
+            SELECT id, username, score, rnk FROM ranked WHERE rnk <= 10 OR id = ? ORDER BY rnk
+        """, (user.id,)) as c:
+            results = await c.fetchall()
 
-        leaderboard_text = translate_text("Leaderboard:\n", get_user_language(user.id))
+        lines = [translate_text("Leaderboard:\n", lang)]
         user_score = None
         user_rank = None
 
-        for i, (user_id, username, score) in enumerate(results, 1):
-            leaderboard_text += f"{i}. {username or 'Anonymous'} - {score}\n"
-            if user.id == user_id:  # Check if the current user's ID is in the leaderboard
+        for user_id, username, score, rank in results:
+            if rank <= 10:
+                lines.append(f"{rank}. {username or 'Anonymous'} - {score}\n")
+            if user.id == user_id:
                 user_score = score
-                user_rank = i
+                user_rank = rank
 
         if user_rank:
-            leaderboard_text += f"\nYour Rank: {user_rank} with a score of {user_score}."
+            lines.append(f"\nYour Rank: {user_rank} with a score of {user_score}.")
         else:
-            leaderboard_text += "\nYou are not in the top 10. Keep playing to improve your score!"
+            lines.append("\nYou are not on the leaderboard yet. Keep playing to improve your score!")
 
-        await update.message.reply_text(leaderboard_text)
+        await update.message.reply_text("".join(lines))
     except sqlite3.OperationalError as e:
         await update.message.reply_text("An error occurred with the database. Please try again later.")
         logging.error(f"Database error in leaderboard: {e}")
@@ -481,25 +671,22 @@ async def leaderboard(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
 async def user_info(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user = update.effective_user
     try:
-        ensure_user_in_db(user)
-        with sqlite3.connect(DB_NAME) as conn:
-            c = conn.cursor()
-
-            # Query user data
-            c.execute("SELECT username, language, score, last_interaction FROM users WHERE id=?", (user.id,))
-            user_data = c.fetchone()
-
-            if user_data:
-                username, language, score, last_interaction = user_data
-                info_text = translate_text(f"""
-                **User Info:**
-                - Username: {username or 'No Username'}
-                - Language: {language or 'Not set'}
-                - Score: {score}
-                - Last Interaction: {last_interaction}
-                """, get_user_language(user.id))
-            else:
-                info_text = translate_text("No user data found. Please start by using /start command.", get_user_language(user.id))
+        lang = await ensure_user_in_db(user)
+        # Query user data
+        async with db.execute("SELECT username, language, score, last_interaction FROM users WHERE id=?", (user.id,)) as c:
+            user_data = await c.fetchone()
+
+        if user_data:
+            username, language, score, last_interaction = user_data
+            info_text = translate_text(f"""
+            **User Info:**
+            - Username: {username or 'No Username'}
+            - Language: {language or 'Not set'}
+            - Score: {score}
+            - Last Interaction: {last_interaction}
+            """, lang)
+        else:
+            info_text = translate_text("No user data found. Please start by using /start command.", lang)
 
         await update.message.reply_text(info_text, parse_mode='Markdown')
     except sqlite3.OperationalError as e:
@@ -509,10 +696,9 @@ async def user_info(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 async def set_language(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user = update.effective_user
     try:
-        ensure_user_in_db(user)
-        buttons = [[InlineKeyboardButton(lang_name, callback_data=f"set_lang_{lang_code}") for lang_code, lang_name in LANGUAGES.items()]]
-        await update.message.reply_text(translate_text("Choose your language:", get_user_language(user.id)),
-                                        reply_markup=InlineKeyboardMarkup(buttons))
+        lang = await ensure_user_in_db(user)
+        await update.message.reply_text(translate_text("Choose your language:", lang),
+                                        reply_markup=LANG_KEYBOARD)
     except sqlite3.OperationalError as e:
         await update.message.reply_text("An error occurred with the database. Please try again later.")
         logging.error(f"Database error in set_language: {e}")
@@ -520,19 +706,18 @@ async def set_language(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
 async def my_quizzes(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user = update.effective_user
     try:
-        ensure_user_in_db(user)
+        lang = await ensure_user_in_db(user)
         user_id = user.id
-        with sqlite3.connect(DB_NAME) as conn:
-            c = conn.cursor()
-            c.execute("SELECT question, answer, quiz_type, created_at FROM quizzes WHERE user_id = ? ORDER BY created_at DESC LIMIT 5", (user_id,))
-            quizzes = c.fetchall()
+        async with db.execute("SELECT question, answer, quiz_type, created_at FROM quizzes WHERE user_id = ? ORDER BY created_at DESC LIMIT 5", (user_id,)) as c:
+            quizzes = await c.fetchall()
 
         if quizzes:
-            quiz_history = translate_text("Your Recent Quizzes:\n", get_user_language(user_id))
-            for question, answer, quiz_type, created_at in quizzes:
-                quiz_history += f"- {quiz_type.capitalize()}: {question} - Answer: {answer}\n  ({created_at})\n"
+            quiz_history = translate_text("Your Recent Quizzes:\n", lang) + "".join(
+                f"- {quiz_type.capitalize()}: {question} - Answer: {answer}\n  ({created_at})\n"
+                for question, answer, quiz_type, created_at in quizzes
+            )
         else:
-            quiz_history = translate_text("You haven't taken any quizzes yet!", get_user_language(user_id))
+            quiz_history = translate_text("You haven't taken any quizzes yet!", lang)
 
         await update.message.reply_text(quiz_history)
     except sqlite3.OperationalError as e:
@@ -542,28 +727,15 @@ async def my_quizzes(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
 async def all_users(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user = update.effective_user
     try:
-        ensure_user_in_db(user)
+        lang = await ensure_user_in_db(user)
         if user.id != YOUR_ADMIN_ID:  # Replace YOUR_ADMIN_ID with the actual user ID of the admin
             await update.message.reply_text("Sorry, you are not authorized to use this command.")
             return
 
-        with sqlite3.connect(DB_NAME) as conn:
-            c = conn.cursor()
-            c.execute("SELECT id, username, score, last_interaction FROM users")
-            users = c.fetchall()
-
-        if users:
-            all_users_text = translate_text("**All Users:**\n", get_user_language(user.id))
-            for id, username, score, last_interaction in users:
-                # Replace None with 'No Username' and escape Markdown characters
-                username = username if username else 'No Username'
-                username = username.replace('_', '\\_').replace('*', '\\*')  # Escape Markdown characters
-                all_users_text += f"- ID: {id}, Username: {username}, Score: {score}, Last Interaction: {last_interaction}\n"
-        else:
-            all_users_text = translate_text("No users have interacted with the bot yet.", get_user_language(user.id))
-        
-        logging.info(f"Users retrieved: {users}")  # Log the retrieved users
-        await update.message.reply_text(all_users_text, parse_mode='Markdown')
+        # Optional page number, e.g. /all_users 2
+        page = int(context.args[0]) if context.args and context.args[0].isdigit() else 1
+        all_users_text, reply_markup = await build_users_page(max(page, 1), lang)
+        await update.message.reply_text(all_users_text, parse_mode='Markdown', reply_markup=reply_markup)
     except sqlite3.OperationalError as e:
         await update.message.reply_text("An error occurred with the database. Please try again later.")
         logging.error(f"Database error in all_users: {e}")
@@ -574,7 +746,7 @@ async def all_users(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 async def show_commands(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user = update.effective_user
     try:
-        ensure_user_in_db(user)
+        await ensure_user_in_db(user)
         if update.message.text == '/':
             commands = [f"/{command.command} - {command.description}" for command in await context.bot.get_my_commands()]
             command_list = "\n".join(commands)
@@ -586,16 +758,14 @@ async def show_commands(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
 async def view_score_history(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user = update.effective_user
     try:
-        ensure_user_in_db(user)
-        with sqlite3.connect(DB_NAME) as conn:
-            c = conn.cursor()
-            c.execute("SELECT score, timestamp FROM score_history WHERE user_id = ? ORDER BY timestamp DESC", (user.id,))
-            history = c.fetchall()
+        await ensure_user_in_db(user)
+        async with db.execute("SELECT score, timestamp FROM score_history WHERE user_id = ? ORDER BY timestamp DESC", (user.id,)) as c:
+            history = await c.fetchall()
 
         if history:
-            history_text = "Your Score History:\n"
-            for score, timestamp in history:
-                history_text += f"- Score: {score}, Date: {timestamp}\n"
+            history_text = "Your Score History:\n" + "".join(
+                f"- Score: {score}, Date: {timestamp}\n" for score, timestamp in history
+            )
         else:
             history_text = "You have no score history yet."
 
@@ -604,41 +774,14 @@ async def view_score_history(update: Update, context: ContextTypes.DEFAULT_TYPE)
         await update.message.reply_text("An error occurred with the database. Please try again later.")
         logging.error(f"Database error in view_score_history: {e}")
 
-async def handle_user_update(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    user = update.effective_user
-    if user.username:  # Check if the user has a username
-        try:
-            with sqlite3.connect(DB_NAME) as conn:
-                c = conn.cursor()
-                # Get the current username from the database
-                c.execute("SELECT username FROM users WHERE id = ?", (user.id,))
-                old_username_row = c.fetchone()
-
-                if old_username_row and old_username_row[0] != user.username:
-                    old_username = old_username_row[0]
-                    # Update the username in the database
-                    c.execute("UPDATE users SET username = ? WHERE id = ?", (user.username, user.id))
-                    logging.info(f"Updated username from {old_username} to {user.username} for user ID {user.id}")
-
-                    # Log the change in the audit table
-                    c.execute("INSERT INTO user_audit (user_id, old_username, new_username) VALUES (?, ?, ?)",
-                              (user.id, old_username, user.username))
-                    logging.info(f"Logged username change in audit table: {user.id}, {old_username} -> {user.username}")
-
-                conn.commit()
-        except sqlite3.Error as e:
-            logging.error(f"Database error in handle_user_update: {e}")
-
 async def some_database_function(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user = update.effective_user
     try:
-        ensure_user_in_db(user)
-        with sqlite3.connect(DB_NAME) as conn:
-            c = conn.cursor()
-            # Perform your database operations here
-            c.execute("SELECT * FROM some_table WHERE user_id = ?", (user.id,))
-            result = c.fetchall()
-            await update.message.reply_text(f"Result: {result}")
+        await ensure_user_in_db(user)
+        # Perform your database operations here
+        async with db.execute("SELECT * FROM some_table WHERE user_id = ?", (user.id,)) as c:
+            result = await c.fetchall()
+        await update.message.reply_text(f"Result: {result}")
     except sqlite3.Error as e:
         await update.message.reply_text("An error occurred with the database. Please try again later.")
         logging.error(f"Database error in some_database_function: {e}")
@@ -646,16 +789,14 @@ async def some_database_function(update: Update, context: ContextTypes.DEFAULT_T
 async def score_history(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user = update.effective_user
     try:
-        ensure_user_in_db(user)
-        with sqlite3.connect(DB_NAME) as conn:
-            c = conn.cursor()
-            c.execute("SELECT score, timestamp FROM score_history WHERE user_id = ? ORDER BY timestamp DESC", (user.id,))
-            history = c.fetchall()
+        await ensure_user_in_db(user)
+        async with db.execute("SELECT score, timestamp FROM score_history WHERE user_id = ? ORDER BY timestamp DESC", (user.id,)) as c:
+            history = await c.fetchall()
 
         if history:
-            history_text = "Your Score History:\n"
-            for score, timestamp in history:
-                history_text += f"- Score: {score}, Date: {timestamp}\n"
+            history_text = "Your Score History:\n" + "".join(
+                f"- Score: {score}, Date: {timestamp}\n" for score, timestamp in history
+            )
         else:
             history_text = "You have no score history yet."
 
@@ -667,11 +808,9 @@ async def score_history(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
 async def reset(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user = update.effective_user
     try:
-        ensure_user_in_db(user)
-        with sqlite3.connect(DB_NAME) as conn:
-            c = conn.cursor()
-            c.execute("UPDATE users SET score = 0 WHERE id = ?", (user.id,))
-            conn.commit()
+        await ensure_user_in_db(user)
+        await db.execute("UPDATE users SET score = 0 WHERE id = ?", (user.id,))
+        await db.commit()
         await update.message.reply_text("Your score has been reset to 0.")
     except sqlite3.OperationalError as e:
         await update.message.reply_text("An error occurred with the database. Please try again later.")
@@ -680,18 +819,17 @@ async def reset(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 async def quiz_history(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user = update.effective_user
     try:
-        ensure_user_in_db(user)
+        await ensure_user_in_db(user)
         user_id = user.id
-        with sqlite3.connect(DB_NAME) as conn:
-            c = conn.cursor()
-            # Fetch quiz history for the user
-            c.execute("SELECT question, answer, quiz_type, created_at FROM quizzes WHERE user_id = ? ORDER BY created_at DESC", (user_id,))
-            history = c.fetchall()
+        # Fetch quiz history for the user
+        async with db.execute("SELECT question, answer, quiz_type, created_at FROM quizzes WHERE user_id = ? ORDER BY created_at DESC", (user_id,)) as c:
+            history = await c.fetchall()
 
         if history:
-            history_text = "Your Quiz History:\n"
-            for question, answer, quiz_type, created_at in history:
-                history_text += f"- {quiz_type.capitalize()}: {question} - Answer: {answer} ({created_at})\n"
+            history_text = "Your Quiz History:\n" + "".join(
+                f"- {quiz_type.capitalize()}: {question} - Answer: {answer} ({created_at})\n"
+                for question, answer, quiz_type, created_at in history
+            )
         else:
             history_text = "You haven't taken any quizzes yet!"
 
@@ -703,13 +841,11 @@ async def quiz_history(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
 async def my_score(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user = update.effective_user
     try:
-        ensure_user_in_db(user)
+        await ensure_user_in_db(user)
         user_id = user.id
-        with sqlite3.connect(DB_NAME) as conn:
-            c = conn.cursor()
-            # Fetch the user's current score
-            c.execute("SELECT score FROM users WHERE id = ?", (user_id,))
-            score = c.fetchone()
+        # Fetch the user's current score
+        async with db.execute("SELECT score FROM users WHERE id = ?", (user_id,)) as c:
+            score = await c.fetchone()
 
         if score:
             await update.message.reply_text(f"Your current score is: {score[0]}")
@@ -719,9 +855,34 @@ async def my_score(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         await update.message.reply_text("An error occurred with the database. Please try again later.")
         logging.error(f"Database error in my_score: {e}")
 
-async def main() -> None:
-    setup_db()
-    application = Application.builder().token(TOKEN).build()
+async def post_init(application: Application) -> None:
+    await open_db()
+    await setup_db()
+    await quiz_api.startup()
+    application.bot_data['flush_task'] = asyncio.create_task(flush_score_history())
+
+    # Set bot commands for Telegram to display
+    await application.bot.set_my_commands(BOT_COMMANDS)
+
+async def post_shutdown(application: Application) -> None:
+    flush_task = application.bot_data['flush_task']
+    flush_task.cancel()
+    with contextlib.suppress(asyncio.CancelledError):
+        await flush_task
+    await write_score_history()
+    await close_db()
+    await quiz_api.shutdown()
+    print("\nBot stopped gracefully!")
+
+def main() -> None:
+    application = (
+        Application.builder()
+        .token(TOKEN)
+        .concurrent_updates(True)  # Process updates concurrently, e.g. while an answer waits for the next question
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
 
     # Command Handlers
     application.add_handler(CommandHandler("start", start))
@@ -738,35 +899,9 @@ async def main() -> None:
     application.add_handler(CallbackQueryHandler(button))
     application.add_handler(MessageHandler(filters.TEXT & filters.Regex('^/$'), show_commands))
 
-    # Register the user update handler
-    application.add_handler(MessageHandler(filters.ALL, handle_user_update))
-
-    # Set bot commands for Telegram to display
-    await application.bot.set_my_commands([
-        BotCommand("start", "Initialize or reset profile"),
-        BotCommand("help", "Show available commands"),
-        BotCommand("quiz", "Start a quiz"),
-        BotCommand("leaderboard", "See top scorers"),
-        BotCommand("user_info", "Check your information"),
-        BotCommand("set_language", "Change bot language"),
-        BotCommand("my_quizzes", "See your quiz history"),
-        BotCommand("all_users", "List all users (admin only)"),
-        BotCommand("score_history", "View your score history"),
-        BotCommand("my_score", "View your current score"),
-        BotCommand("reset", "Reset your score to 0")
-    ])
-
     print("Starting bot...")
-    await application.initialize()
-    await application.start()
-    await application.updater.start_polling()
-
-    try:
-        await asyncio.Event().wait()
-    except KeyboardInterrupt:
-        print("\nBot stopped gracefully!")
-    finally:
-        await application.stop()
+    # Only messages and button presses are handled, so don't ask Telegram for other update types
+    application.run_polling(allowed_updates=[Update.MESSAGE, Update.CALLBACK_QUERY])
 
 if __name__ == '__main__':
-    asyncio.run(main())
\ No newline at end of file
+    main()
\ No newline at end of file
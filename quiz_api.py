@@ -1,83 +1,206 @@
 import aiohttp
+import orjson
+import contextlib
+import hashlib
 import logging
 import random
-from typing import Dict, Optional, List
-import html
+import time
+from collections import defaultdict, deque
+from types import MappingProxyType
+from typing import Dict, Optional, List, Tuple
+from urllib.parse import unquote
 import asyncio
 
+logger = logging.getLogger(__name__)
+
+# Difficulty levels OpenTDB accepts, for membership checks
+_DIFFICULTIES = frozenset(('easy', 'medium', 'hard'))
+
 
 def format_question(question_data: Dict) -> Dict:
-    """Format the question data for use in the bot."""
-    question = html.unescape(question_data['question'])
-    correct_answer = html.unescape(question_data['correct_answer'])
-    incorrect_answers = [html.unescape(ans) for ans in question_data['incorrect_answers']]
+    """Format the question data for use in the bot.
+
+    Questions are requested with encode=url3986, so every text field is percent-decoded
+    here instead of being HTML-unescaped.
+    """
+    question = unquote(question_data['question'])
+    correct_answer = unquote(question_data['correct_answer'])
+    incorrect_answers = [unquote(ans) for ans in question_data['incorrect_answers']]
     
-    # Enhanced option randomization
-    options = [*incorrect_answers, correct_answer]
-    for _ in range(3):  # Shuffle multiple times for better randomization
-        random.shuffle(options)
+    # A single Fisher-Yates shuffle is already uniform
+    options = incorrect_answers
+    random.shuffle(options)
+    # Put the correct answer at a random position and remember where it is
+    correct_index = random.randrange(len(options) + 1)
+    options.insert(correct_index, correct_answer)
 
     return {
         'question': question,
         'answer': correct_answer,
         'options': options,
-        'quiz_type': question_data['category'],
-        'difficulty': question_data['difficulty']
+        'correct_index': correct_index,
+        'quiz_type': unquote(question_data['category']),
+        'difficulty': unquote(question_data['difficulty'])
     }
 
 
+class _BloomFilter:
+    """Fixed-size Bloom filter of strings, used to remember which questions were already served.
+
+    False positives only make us skip a question we haven't actually used, which is harmless.
+    """
+    __slots__ = ('_bits', '_num_bits', '_num_hashes', '_count')
+
+    def __init__(self, size_bytes: int = 8192, num_hashes: int = 7):
+        self._bits = bytearray(size_bytes)
+        self._num_bits = size_bytes * 8
+        self._num_hashes = num_hashes
+        self._count = 0
+
+    def _positions(self, item: str):
+        # Double hashing: derive all bit positions from two 64-bit halves of one digest
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self._num_bits for i in range(self._num_hashes)]
+
+    def __contains__(self, item: str) -> bool:
+        bits = self._bits
+        return all(bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(item))
+
+    def add(self, item: str):
+        bits = self._bits
+        for pos in self._positions(item):
+            bits[pos >> 3] |= 1 << (pos & 7)
+        self._count += 1
+
+    def clear(self):
+        self._bits[:] = bytes(len(self._bits))
+        self._count = 0
+
+    def __len__(self) -> int:
+        """Number of items added since the last clear."""
+        return self._count
+
+
 class QuizAPI:
+    __slots__ = (
+        'session', 'session_token', 'last_token_refresh', 'used_questions',
+        '_buffers', '_inflight', '_refill_tasks', '_session_lock', '_token_lock',
+        '_rate_lock', '_last_request', '_foreground_waiting', '_batch_sizes'
+    )
+
+    BASE_URL = "https://opentdb.com/api.php"
+    TOKEN_URL = "https://opentdb.com/api_token.php"
+
+    # Map our categories to Open Trivia DB category IDs
+    CATEGORY_MAP = MappingProxyType({
+        'general': 9,      # General Knowledge
+        'science': 17,     # Science & Nature
+        'history': 23,     # History
+        'geography': 22,   # Geography
+        'sports': 21,      # Sports
+        'entertainment': 11, # Entertainment: Film
+        'books': 10,       # Books
+        'music': 12,       # Music
+        'television': 14,  # Television
+        'videogames': 15,  # Video Games
+        'boardgames': 16,  # Board Games
+        'computers': 18,   # Computers
+        'mathematics': 19, # Mathematics
+        'mythology': 20,   # Mythology
+        'politics': 24,    # Politics
+        'art': 25,        # Art
+        'celebrities': 26, # Celebrities
+        'animals': 27,     # Animals
+        'vehicles': 28,    # Vehicles
+        'comics': 29,      # Comics
+        'gadgets': 30,     # Gadgets
+        'anime': 31,       # Anime & Manga
+        'cartoons': 32     # Cartoon & Animations
+    })
+    # Precomputed choices for the random category and difficulty switches
+    _category_keys = tuple(CATEGORY_MAP.keys())
+    _difficulties = ('easy', 'medium', 'hard')
+
+    BATCH_SIZE = 50       # Questions requested per API call (the most OpenTDB allows)
+    LOW_WATER_MARK = 10   # Refill a buffer in the background once it drops below this
+    MAX_ATTEMPTS = 3      # Attempts per API call before giving up
+    RETRY_DELAY = 0.3     # Base delay in seconds for exponential backoff between attempts
+    REQUEST_TIMEOUT = 10  # Total seconds allowed per API request
+    MAX_RETRIES = 5       # Buffers tried per get_question call before giving up
+    MAX_USED_QUESTIONS = 5000  # Questions remembered before the used-questions filter starts over
+    RATE_LIMIT_INTERVAL = 5  # OpenTDB allows one questions request per IP every 5 seconds
+    QUESTION_TIMEOUT = 20    # Seconds get_question may take in total before giving up
+
+    # Connection pool settings for the single host we talk to, connections are kept
+    # alive between questions so each call doesn't pay for a new TCP+TLS handshake
+    CONNECTOR_KWARGS = {
+        'limit': 10,
+        'limit_per_host': 4,
+        'keepalive_timeout': 75,
+        'ttl_dns_cache': 300,
+        'enable_cleanup_closed': True
+    }
+    HEADERS = {'User-Agent': 'quiz-telegram-bot/1.0'}
+    # Query parameters shared by every questions request, copied and completed per call
+    PARAMS_TEMPLATE = {
+        'type': 'multiple',
+        'encode': 'url3986'  # Percent-encoded fields, decoded with unquote() in format_question
+    }
+
     def __init__(self):
-        self.base_url = "https://opentdb.com/api.php"
-        self.token_url = "https://opentdb.com/api_token.php"
         self.session = None
         self.session_token = None
         self.last_token_refresh = None
-        self.used_questions = set()  # Track used questions to avoid repetition
-        
-        # Map our categories to Open Trivia DB category IDs
-        self.category_map = {
-            'general': 9,      # General Knowledge
-            'science': 17,     # Science & Nature
-            'history': 23,     # History
-            'geography': 22,   # Geography
-            'sports': 21,      # Sports
-            'entertainment': 11, # Entertainment: Film
-            'books': 10,       # Books
-            'music': 12,       # Music
-            'television': 14,  # Television
-            'videogames': 15,  # Video Games
-            'boardgames': 16,  # Board Games
-            'computers': 18,   # Computers
-            'mathematics': 19, # Mathematics
-            'mythology': 20,   # Mythology
-            'politics': 24,    # Politics
-            'art': 25,        # Art
-            'celebrities': 26, # Celebrities
-            'animals': 27,     # Animals
-            'vehicles': 28,    # Vehicles
-            'comics': 29,      # Comics
-            'gadgets': 30,     # Gadgets
-            'anime': 31,       # Anime & Manga
-            'cartoons': 32     # Cartoon & Animations
-        }
+        # Track used questions to avoid repetition in constant memory
+        self.used_questions = _BloomFilter()
+        # Prefetched questions per (category, difficulty), already formatted and refilled in batches
+        self._buffers: Dict[Tuple[str, str], deque] = defaultdict(deque)
+        # Refills currently running per key, so concurrent callers share one API call
+        self._inflight: Dict[Tuple[str, str], asyncio.Future] = {}
+        # Guard lazy session and token setup so concurrent first calls don't race
+        self._session_lock = asyncio.Lock()
+        self._token_lock = asyncio.Lock()
+        self._refill_tasks: Dict[Tuple[str, str], asyncio.Task] = {}
+        # Largest batch each key last returned, for keys with fewer than BATCH_SIZE questions left
+        self._batch_sizes: Dict[Tuple[str, str], int] = {}
+        # Questions requests go out one at a time, spaced by RATE_LIMIT_INTERVAL
+        self._rate_lock = asyncio.Lock()
+        self._last_request = float('-inf')
+        # Foreground callers waiting for the rate limit, background prefetches let them go first
+        self._foreground_waiting = 0
+
+    async def startup(self, connector: Optional[aiohttp.BaseConnector] = None):
+        """Open the aiohttp session, optionally on a connector shared with the rest of the app.
+
+        A connector passed in stays owned by the caller and isn't closed on shutdown.
+        """
+        async with self._session_lock:
+            if self.session is None:
+                self.session = aiohttp.ClientSession(
+                    connector=connector or aiohttp.TCPConnector(**self.CONNECTOR_KWARGS),
+                    connector_owner=connector is None,
+                    headers=self.HEADERS,
+                    timeout=aiohttp.ClientTimeout(total=self.REQUEST_TIMEOUT)
+                )
 
     async def _ensure_session(self):
         if self.session is None:
-            self.session = aiohttp.ClientSession()
+            await self.startup()
 
     async def _get_session_token(self) -> Optional[str]:
         """Get a new session token from the API to ensure question uniqueness."""
         try:
             await self._ensure_session()
             params = {'command': 'request'}
-            async with self.session.get(self.token_url, params=params) as response:
+            async with self.session.get(self.TOKEN_URL, params=params) as response:
                 if response.status == 200:
-                    data = await response.json()
+                    data = orjson.loads(await response.read())
                     if data['response_code'] == 0:
                         return data['token']
         except Exception as e:
-            logging.error(f"Error getting session token: {e}")
+            logger.error("Error getting session token: %s", e)
         return None
 
     async def _reset_token(self) -> bool:
@@ -85,88 +208,219 @@ class QuizAPI:
         try:
             if self.session_token:
                 params = {'command': 'reset', 'token': self.session_token}
-                async with self.session.get(self.token_url, params=params) as response:
+                async with self.session.get(self.TOKEN_URL, params=params) as response:
                     if response.status == 200:
-                        data = await response.json()
+                        data = orjson.loads(await response.read())
                         return data['response_code'] == 0
         except Exception as e:
-            logging.error(f"Error resetting token: {e}")
+            logger.error("Error resetting token: %s", e)
         return False
 
     async def _ensure_token(self):
-        """Ensure we have a valid session token."""
-        if not self.session_token:
-            self.session_token = await self._get_session_token()
-        elif len(self.used_questions) > 100:  # Reset after many questions
+        """Ensure we have a valid session token.
+
+        The token is only reset once the API reports it empty (response code 4), so it keeps
+        deduplicating questions server side for as long as it can.
+        """
+        if self.session_token:
+            return
+        async with self._token_lock:
+            # Re-check, another caller may have fetched the token while we waited
+            if not self.session_token:
+                self.session_token = await self._get_session_token()
+
+    @contextlib.asynccontextmanager
+    async def _rate_limited(self, background: bool = False):
+        """Hold the questions endpoint until RATE_LIMIT_INTERVAL has passed since the last request finished."""
+        if background:
+            await self._rate_lock.acquire()
+            while self._foreground_waiting:
+                # Give way to a foreground caller, re-queueing behind it
+                self._rate_lock.release()
+                await self._rate_lock.acquire()
+        else:
+            self._foreground_waiting += 1
+            try:
+                await self._rate_lock.acquire()
+            finally:
+                self._foreground_waiting -= 1
+        try:
+            delay = self._last_request + self.RATE_LIMIT_INTERVAL - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            try:
+                yield
+            finally:
+                self._last_request = time.monotonic()
+        finally:
+            self._rate_lock.release()
+
+    async def _fetch_questions(self, category: str, difficulty: str, amount: int,
+                               background: bool = False) -> Optional[Dict]:
+        """Request a batch of questions, retrying with exponential backoff on failure."""
+        params = {**self.PARAMS_TEMPLATE, 'amount': amount}
+
+        if self.session_token:
+            params['token'] = self.session_token
+
+        if category in self.CATEGORY_MAP:
+            params['category'] = self.CATEGORY_MAP[category]
+
+        if difficulty in _DIFFICULTIES:
+            params['difficulty'] = difficulty
+
+        for attempt in range(self.MAX_ATTEMPTS):
+            try:
+                async with self._rate_limited(background), self.session.get(self.BASE_URL, params=params) as response:
+                    if response.status == 200:
+                        data = orjson.loads(await response.read())
+                        if data['response_code'] != 5:  # 5 means rate limited, worth retrying
+                            return data
+                    else:
+                        logger.error("API request failed with status %s", response.status)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logger.error("Error fetching questions from API: %r", e)
+            if attempt < self.MAX_ATTEMPTS - 1:
+                await asyncio.sleep(self.RETRY_DELAY * 2 ** attempt)
+        return None
+
+    async def _refill(self, key: Tuple[str, str], background: bool = False) -> Optional[int]:
+        """Fetch a batch of questions into the buffer for key, returning the API response code.
+
+        Concurrent calls for the same key wait for the refill already in flight instead of
+        sending their own request.
+        """
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            # Shielded so a cancelled waiter doesn't cancel the shared refill
+            return await asyncio.shield(inflight)
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        response_code = None
+        try:
+            response_code = await self._fill_buffer(key, background)
+        finally:
+            del self._inflight[key]
+            future.set_result(response_code)
+        return response_code
+
+    async def _fill_buffer(self, key: Tuple[str, str], background: bool = False) -> Optional[int]:
+        amount = self._batch_sizes.get(key, self.BATCH_SIZE)
+        data = await self._fetch_questions(*key, amount, background)
+        while data is not None and data['response_code'] == 1 and amount > 1:
+            # Fewer questions than requested are left for this category and difficulty,
+            # halve the batch (the rate limit spaces the requests out)
+            amount //= 2
+            data = await self._fetch_questions(*key, amount, background)
+        if data is None:
+            return None
+
+        if data['response_code'] == 0:
+            if amount < self.BATCH_SIZE:
+                self._batch_sizes[key] = amount  # Ask for what is actually available next time
+            self._buffers[key].extend(format_question(question) for question in data['results'])
+        elif data['response_code'] == 4:  # Token empty (all questions used)
             await self._reset_token()
             self.used_questions.clear()
+            self._batch_sizes.clear()
+        else:
+            logger.error("API returned no results: %s", data)
+        return data['response_code']
+
+    async def _background_refill(self, key: Tuple[str, str]):
+        try:
+            if self._rate_lock.locked():
+                # Don't queue behind other requests, a later question will schedule it again
+                return
+            await self._refill(key, background=True)
+        except Exception as e:
+            logger.error("Error prefetching questions from API: %s", e)
+        finally:
+            self._refill_tasks.pop(key, None)
 
-    def _generate_question_hash(self, question_data: Dict) -> str:
-        """Generate a unique hash for a question to track duplicates."""
-        return f"{question_data['question']}_{question_data['category']}_{question_data['difficulty']}"
+    def _pop_unused(self, buffer: deque) -> Optional[Dict]:
+        """Pop the next buffered question that hasn't been used yet."""
+        while buffer:
+            question = buffer.popleft()
+            if question['question'] not in self.used_questions:
+                # Track this question as used, starting over before false positives pile up
+                # (the session token still keeps the API from repeating questions)
+                if len(self.used_questions) >= self.MAX_USED_QUESTIONS:
+                    self.used_questions.clear()
+                self.used_questions.add(question['question'])
+                return question
+        return None
 
     async def get_question(self, category: str = 'general', difficulty: str = 'medium') -> Optional[Dict]:
-        """Fetch a single quiz question from the Open Trivia Database with enhanced randomization."""
+        """Fetch a single formatted quiz question from the Open Trivia Database with enhanced randomization.
+
+        Questions are served from a local buffer per category and difficulty, which is
+        refilled in batches so most calls don't need an HTTP round trip.
+        """
         try:
-            await self._ensure_session()
-            await self._ensure_token()
-
-            # Sometimes randomly choose a different category or difficulty for variety
-            if random.random() < 0.1:  # 10% chance to switch category
-                category = random.choice(list(self.category_map.keys()))
-            if random.random() < 0.1:  # 10% chance to switch difficulty
-                difficulty = random.choice(['easy', 'medium', 'hard'])
-
-            params = {
-                'amount': 3,  # Request multiple questions for better randomization
-                'type': 'multiple',
-                'token': self.session_token
-            }
-            
-            if category in self.category_map:
-                params['category'] = self.category_map[category]
-            
-            if difficulty in ['easy', 'medium', 'hard']:
-                params['difficulty'] = difficulty
-            
-            async with self.session.get(self.base_url, params=params) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    if data['response_code'] == 0 and data['results']:
-                        # Filter out previously used questions
-                        new_questions = [q for q in data['results'] 
-                                      if self._generate_question_hash(q) not in self.used_questions]
-                        
-                        if not new_questions:
-                            # If all questions were used, try again with a different category
-                            return await self.get_question(
-                                random.choice(list(self.category_map.keys())),
-                                difficulty
-                            )
-                        
-                        # Choose a random question from the results
-                        chosen_question = random.choice(new_questions)
-                        
-                        # Track this question as used
-                        self.used_questions.add(self._generate_question_hash(chosen_question))
-                        
-                        return chosen_question
-                    elif data['response_code'] == 4:  # Token empty (all questions used)
-                        await self._reset_token()
-                        self.used_questions.clear()
-                        return await self.get_question(category, difficulty)
-                    else:
-                        logging.error(f"API returned no results: {data}")
-                        return None
-                else:
-                    logging.error(f"API request failed with status {response.status}")
-                    return None
+            return await asyncio.wait_for(self._next_question(category, difficulty), self.QUESTION_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.error("Timed out fetching a question for %s/%s", category, difficulty)
         except Exception as e:
-            logging.error(f"Error fetching question from API: {e}")
-            return None
+            logger.error("Error fetching question from API: %r", e)
+        return None
+
+    async def _next_question(self, category: str, difficulty: str) -> Optional[Dict]:
+        await self._ensure_session()
+        await self._ensure_token()
+
+        # Sometimes randomly choose a different category or difficulty for variety,
+        # one byte of a single random draw per decision (26/256 is about 10%)
+        r = random.getrandbits(16)
+        if r & 0xFF < 26:  # 10% chance to switch category
+            category = random.choice(self._category_keys)
+        if r >> 8 < 26:  # 10% chance to switch difficulty
+            difficulty = random.choice(self._difficulties)
+
+        for attempt in range(self.MAX_RETRIES):
+            key = (category, difficulty)
+            buffer = self._buffers[key]
+            chosen_question = self._pop_unused(buffer)
+
+            if chosen_question is None:
+                response_code = await self._refill(key)
+                if response_code == 4:
+                    continue  # Token was reset, try the same category again
+                if response_code != 0:
+                    return None
+
+                chosen_question = self._pop_unused(buffer)
+                if chosen_question is None:
+                    # If all questions were used, try again with a different category
+                    category = random.choice(self._category_keys)
+                    continue
 
-    async def close(self):
-        """Close the aiohttp session."""
+            # Top the buffer up in the background before it runs dry, keys with small
+            # batches are refilled once less than a batch is left
+            low_water_mark = min(self.LOW_WATER_MARK, self._batch_sizes.get(key, self.BATCH_SIZE))
+            if len(buffer) < low_water_mark and key not in self._refill_tasks:
+                self._refill_tasks[key] = asyncio.create_task(self._background_refill(key))
+
+            return chosen_question
+        return None
+
+    async def shutdown(self):
+        """Cancel pending prefetches and close the aiohttp session."""
+        for task in self._refill_tasks.values():
+            task.cancel()
+        self._refill_tasks.clear()
         if self.session:
             await self.session.close()
-            self.session = None
\ No newline at end of file
+            self.session = None
+
+
+_default: Optional[QuizAPI] = None
+
+
+def get_quiz_api() -> QuizAPI:
+    """Return the QuizAPI shared by the whole bot, so there is one session and connection pool."""
+    global _default
+    if _default is None:
+        _default = QuizAPI()
+    return _default
\ No newline at end of file